@@ -7,14 +7,23 @@ from berkleydb_cache import BerkleyDbCache
 from rocksdicts_cache import RocksdictCache
 from lmdb_cache import LmdbCache
 
+# Maps the byte values below 248 to the 62 alphanumeric characters, 4 each.
+# The other 8 byte values are dropped, so every character is equally likely
+ALPHANUMERIC_TABLE = (string.ascii_letters + string.digits).encode() * 4 + bytes(8)
+ALPHANUMERIC_DROPPED = bytes(range(len(ALPHANUMERIC_TABLE) - 8, 256))
+
 # Generate random data
 def random_string(length=10):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    data = b''
+    while len(data) < length:
+        # about 3% of the bytes are dropped, draw a few more than needed
+        data += random.randbytes(length - len(data) + 8).translate(ALPHANUMERIC_TABLE, ALPHANUMERIC_DROPPED)
+    return data[:length].decode('ascii')
 
 def alphanumeric_string(length=10):
     alphanumeric_characters = string.ascii_lowercase + string.ascii_uppercase + string.digits
     total_characters = len(alphanumeric_characters)
-    return ''.join(alphanumeric_characters[i % total_characters] for i in range(length))
+    return (alphanumeric_characters * (length // total_characters + 1))[:length]
 
 def benchmark_all(num_entries, entry_size):
     print(f'## Generating random data for {num_entries} entries, {entry_size} bytes each')
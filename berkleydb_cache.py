@@ -1,20 +1,54 @@
 import dbm
 
+try:
+    import dbm.gnu as gdbm
+except ImportError:
+    gdbm = None
+
+try:
+    import dbm.ndbm as ndbm
+except ImportError:
+    ndbm = None
+
+def open_db(filename):
+    ''' Open the fastest dbm backend which is available. gdbm is opened in
+        fast mode, which does not sync to the disk after every write. Without
+        gdbm or ndbm `dbm` falls back to the slow `dbm.dumb`. '''
+    if gdbm is not None:
+        return gdbm.open(filename, 'cf')
+    if ndbm is not None:
+        return ndbm.open(filename, 'c')
+    return dbm.open(filename, 'c')
+
 class BerkleyDbCache:
     def __init__(self, filename):
         self.filename = filename+'.dbm'
-        self.db = dbm.open(self.filename, 'c')
+        self.db = open_db(self.filename)
 
     def __enter__(self):
-        self.db = dbm.open(self.filename, 'c')
+        self.db = open_db(self.filename)
         return self.db
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def sync(self):
+        # ndbm has no sync()
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+    def close(self):
+        self.sync()
         self.db.close()
 
     def set(self, key, value):
         self.db[key] = value
 
+    def set_many(self, items):
+        for key, value in items.items() if isinstance(items, dict) else items:
+            self.db[key] = value
+        self.sync()
+
     def get(self, key):
         return self.db[key]
 
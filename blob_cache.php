@@ -55,9 +55,18 @@
  *
  *     bytes     type        decription
  *     -------   ----        ----------
+ *     1 byte    int         flags, see below
  *     4 bytes   long        [n] lenth of data (max 2^32-1 bytes)
- *     1 byte    int         0 = data json, 1 = byte data
- *     n bytes   *char[n]    GZIPed data (max 2^32-1 bytes)
+ *     n bytes   *char[n]    compressed data (max 2^32-1 bytes)
+ *     4 bytes   long        CRC32 of the bytes above, only if flags bit 7 is set
+ *
+ *     Flags byte:
+ *
+ *     bits      decription
+ *     ----      ----------
+ *     0-1       0 = data json, 1 = byte data, 2 = utf-8 string
+ *     2-4       codec: 0 = zlib, 1 = none (stored), 2 = zstd, 3 = lz4
+ *     7         1 = frame ends with a CRC32 checksum
  *
  * Index file:
  *
@@ -66,6 +75,7 @@
  *     4 bytes   long        [n] length of key
  *     n bytes   *char[n]    key string
  *     8 bytes   long long   data frame position in data file
+ *     4 bytes   long        data frame length
  *     4 bytes   long        expiration timestamp
  *
  * WAL file:
@@ -74,9 +84,12 @@
  *     -------   ----        ----------
  *     4 bytes   long        [n] length of key
  *     n bytes   *char[n]    key string
- *     1 byte    bool        0 = delete, 1 = add/update
- *     8 bytes   long long   data frame position in data file
- *     4 bytes   long        expiration timestamp
+ *     1 byte    int         flags, bit 0: 0 = delete, 1 = add/update
+ *                                  bit 1: 1 = record ends with a CRC32 checksum
+ *     8 bytes   long long   data frame position in data file (add/update only)
+ *     4 bytes   long        data frame length (add/update only)
+ *     4 bytes   long        expiration timestamp (add/update only)
+ *     4 bytes   long        CRC32 of the bytes above, only if flags bit 1 is set
  *
  */
 
@@ -84,6 +97,11 @@ class BlobCache
 {
     const HEADER_DATA_FILE = 'blob.cache.data.01'; // The header of the data file.
     const PACK_FORMAT_INDEX = 'QII'; // The format of the index entry in the index file. long long start, int length, int expires.
+    const CODEC_ZLIB = 0; // Codec ids stored in bits 2-4 of the frame flags byte.
+    const CODEC_NONE = 1;
+    const FRAME_FLAG_CHECKSUM = 0x80; // Data frame ends with a CRC32 of the frame.
+    const WAL_FLAG_ADD = 0x01; // WAL record adds/updates a key, otherwise it deletes it.
+    const WAL_FLAG_CHECKSUM = 0x02; // WAL record ends with a CRC32 of the record.
 
     private $stats;
     private $dataFile;
@@ -210,10 +228,31 @@ class BlobCache
                     break;
                 }
                 $keyLength = unpack('I', $keyLengthBytes)[1];
-                $key = fread($f, $keyLength);
-                $entryFlag = unpack('C', fread($f, 1))[1];
-                if ($entryFlag) {
+                $key = $keyLength > 0 ? fread($f, $keyLength) : '';
+                $entryFlagByte = fread($f, 1);
+                if (strlen($key) < $keyLength || strlen($entryFlagByte) < 1) {
+                    break;
+                }
+                $entryFlag = unpack('C', $entryFlagByte)[1];
+                $entryData = '';
+                if ($entryFlag & self::WAL_FLAG_ADD) {
                     $entryData = fread($f, 16);
+                    if (strlen($entryData) < 16) {
+                        break;
+                    }
+                }
+                if ($entryFlag & self::WAL_FLAG_CHECKSUM) {
+                    // stop at records which are corrupted or partially written
+                    $checksumBytes = fread($f, 4);
+                    if (strlen($checksumBytes) < 4) {
+                        break;
+                    }
+                    $record = $keyLengthBytes . $key . $entryFlagByte . $entryData;
+                    if (unpack('V', $checksumBytes)[1] != crc32($record)) {
+                        break;
+                    }
+                }
+                if ($entryFlag & self::WAL_FLAG_ADD) {
                     list($start, $length, $expires) = array_values(unpack('Qstart/Ilength/Iexpires', $entryData));
                     if ($expires == 0 || $expires > $now) {
                         $index[$key] = array(
@@ -319,10 +358,25 @@ class BlobCache
     private function readFrameFromDataFile($start)
     {
         fseek($this->dataFileReadFd, $start);
-        $isBytes = unpack('C', fread($this->dataFileReadFd, 1))[1];
-        $dataLength = unpack('I', fread($this->dataFileReadFd, 4))[1];
-        $compressedData = fread($this->dataFileReadFd, $dataLength);
-        $data = gzuncompress($compressedData);
+        $header = fread($this->dataFileReadFd, 5);
+        $flags = unpack('C', $header)[1];
+        $isBytes = $flags & 0x03;
+        $codec = ($flags >> 2) & 0x07;
+        $dataLength = unpack('I', substr($header, 1, 4))[1];
+        $compressedData = $dataLength > 0 ? fread($this->dataFileReadFd, $dataLength) : '';
+        if ($flags & self::FRAME_FLAG_CHECKSUM) {
+            $checksum = unpack('V', fread($this->dataFileReadFd, 4))[1];
+            if ($checksum != crc32($header . $compressedData)) {
+                throw new Exception('Data frame is corrupted, checksum mismatch');
+            }
+        }
+        if ($codec == self::CODEC_ZLIB) {
+            $data = gzuncompress($compressedData);
+        } elseif ($codec == self::CODEC_NONE) {
+            $data = $compressedData;
+        } else {
+            throw new Exception("Data frame codec `{$codec}` is not supported");
+        }
         if ($isBytes == 0) {
             $data = json_decode($data, $this->decodeAsArray);
         }
@@ -16,9 +16,10 @@ What is this?
 -------------
 
 Persistent key-value store with a write-ahead log (WAL) for crash recovery. The
-data is compressed using zlib and stored in a single data file. The index is
-stored in a separate file. Keys must be strings. Values can be any 
-JSON-serializable object or bytes.
+data is compressed using zlib (or optionally zstd/lz4) and stored in a single
+data file. The index is stored in a separate file. Keys must be strings or
+bytes, strings are stored as UTF-8. Values can be any JSON-serializable object
+or bytes.
 
 The reason for this is to overcome the limitations when storing cache on the
 filesystem as a separate file. Each file is basically a key-value pair, name
@@ -33,7 +34,9 @@ This approach is also faster than storing each key-value pair in a separate
 file, it is slower than using `LMDB` or `RocksDb`. On PHP platform those are
 not always readily available and in our case performance was good enough.
 
-There are no external dependencies.
+There are no external dependencies. The `zstd` and `lz4` codecs are optional
+and need the `zstandard` and `lz4` packages. JSON is serialized with `orjson`
+when it is installed.
 
 
 Drawbacks
@@ -53,7 +56,8 @@ Notes
 
 - All methods which are not thread safe have the `_unsafe` suffix and start
   with `_` prefix. This means that these methods should be called within a
-  context manager with `with self._thread_lock:`.
+  context manager with `with self._thread_lock:`. The lock belongs to the
+  instance, so caches on different files do not block each other.
 
 
 BLOB FORMATS
@@ -63,9 +67,18 @@ Data file:
 
     bytes     type        decription
     -------   ----        ----------
+    1 byte    int         flags, see below
     4 bytes   long        [n] lenth of data (max 2^32-1 bytes)
-    1 byte    int         0 = data json, 1 = byte data
-    n bytes   *char[n]    GZIPed data (max 2^32-1 bytes)
+    n bytes   *char[n]    compressed data (max 2^32-1 bytes)
+    4 bytes   long        CRC32 of the bytes above, only if flags bit 7 is set
+
+    Flags byte:
+
+    bits      decription
+    ----      ----------
+    0-1       0 = data json, 1 = byte data, 2 = utf-8 string
+    2-4       codec: 0 = zlib, 1 = none (stored), 2 = zstd, 3 = lz4
+    7         1 = frame ends with a CRC32 checksum
 
 Index file:
 
@@ -74,6 +87,7 @@ Index file:
     4 bytes   long        [n] length of key
     n bytes   *char[n]    key string
     8 bytes   long long   data frame position in data file
+    4 bytes   long        data frame length
     4 bytes   long        expiration timestamp
 
 WAL file:
@@ -82,21 +96,127 @@ WAL file:
     -------   ----        ----------
     4 bytes   long        [n] length of key
     n bytes   *char[n]    key string
-    1 byte    bool        0 = delete, 1 = add/update
-    8 bytes   long long   data frame position in data file
-    4 bytes   long        expiration timestamp
+    1 byte    int         flags, bit 0: 0 = delete, 1 = add/update
+                                 bit 1: 1 = record ends with a CRC32 checksum
+    8 bytes   long long   data frame position in data file (add/update only)
+    4 bytes   long        data frame length (add/update only)
+    4 bytes   long        expiration timestamp (add/update only)
+    4 bytes   long        CRC32 of the bytes above, only if flags bit 1 is set
 
 '''
 
-import io
+import atexit
+import mmap
+import weakref
 import zlib
 import struct
 import json
 import os
 import time
 import fcntl
-from typing import Callable, Union, Optional
-from threading import Lock
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterable, Union, Optional
+from threading import RLock, local
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# fdatasync() is not available on all platforms (macOS)
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+# posix_fallocate() is not available on all platforms (macOS)
+_posix_fallocate = getattr(os, 'posix_fallocate', None)
+# copy_file_range() is only available on Linux
+_copy_file_range = getattr(os, 'copy_file_range', None)
+
+def _copy_range(src_fd: int, dst_fd: int, count: int, offset_src: int, offset_dst: int) -> int:
+    ''' Copy `count` bytes from one file to another and return the number of
+        bytes copied, which is less at the end of the source file. The bytes
+        are copied within the kernel with `os.copy_file_range()` if possible
+        and with `os.pread()` and `os.pwrite()` otherwise. '''
+    copied = 0
+    if _copy_file_range is not None:
+        try:
+            while copied < count:
+                n = _copy_file_range(src_fd, dst_fd, count - copied, offset_src + copied, offset_dst + copied)
+                if n == 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError:
+            # not supported by the file system (or the kernel), copy the
+            # rest in user space
+            pass
+    while copied < count:
+        data = os.pread(src_fd, min(count - copied, 1 << 20), offset_src + copied)
+        if not data:
+            break
+        copied += os.pwrite(dst_fd, data, offset_dst + copied)
+    return copied
+
+def _json_default(value):
+    ''' Convert values JSON has no type for. Sets are stored as lists. '''
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+if orjson is not None:
+    # dates and dataclasses go to `_json_default`, which rejects them as json
+    # does. `UUID` and `Enum` values are still written by orjson, and are
+    # read back as `str` and as their value
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+def _json_dumps(value) -> bytes:
+    ''' Serialize a value to JSON, using `orjson` if it is installed. Values
+        orjson cannot write as json does are written by json, with a leading
+        space so `_json_loads()` reads them back with json. '''
+    if orjson is not None:
+        try:
+            data = orjson.dumps(value, default=_json_default, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # e.g. integers larger than 64 bits, which json can serialize
+            pass
+        else:
+            # orjson writes NaN and Infinity as null, json keeps them. If
+            # the value reads back equal, no float was turned into null
+            if b'null' not in data or orjson.loads(data) == value:
+                return data
+    data = json.dumps(value, default=_json_default).encode()
+    return b' ' + data if orjson is not None else data
+
+def _json_loads(data: bytes):
+    ''' Deserialize JSON, using `orjson` if it is installed. '''
+    if orjson is not None and data[:1] != b' ':
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # e.g. NaN and Infinity, which json writes
+            pass
+    return json.loads(data)
+
+def _exit_hook(cache_ref: weakref.ref) -> Callable[[], None]:
+    ''' Return an `atexit` hook which writes a cache that is not closed.
+        The cache is weakly referenced, so the hook does not keep it alive. '''
+    def hook():
+        cache = cache_ref()
+        if cache is not None:
+            cache._write_unclosed()
+    return hook
 
 import logging
 # Set up global logging
@@ -110,15 +230,94 @@ class BlobCache:
     header_data_file = b'blob.cache.data.01'
     ''' The header of the data file. '''
 
-    pack_format_index = 'QII'
+    pack_format_index = '<QII'
     ''' The format of the index entry in the index file. long 
         long start, int length, int expires.'''
 
-    stats = {}
-
-    _thread_lock = Lock()
-
-    def __init__(self, data_file: str, auto_vacuum_threshold: float = 0.5):
+    # Precompiled structs, so the format is not parsed on every call. The
+    # formats are little endian, which is what the PHP version writes on
+    # all common platforms.
+    _S_I = struct.Struct('<I')
+    _S_ENTRY = struct.Struct(pack_format_index)
+    _S_HDR = struct.Struct('<BI')
+    ''' Header of a data frame, flags and the length of the data. '''
+    _S_WAL_ADD = struct.Struct('<B' + pack_format_index[1:])
+    ''' Flags and index entry of an add/update WAL record, after the key. '''
+    _S_ADLER32 = struct.Struct('>I')
+    ''' Adler-32 checksum at the end of a zlib stream, big endian. '''
+
+    _MAX_UINT32 = 0xFFFFFFFF
+    ''' Largest frame length and expiration timestamp of an index entry. '''
+
+    _ZLIB_FINAL_BLOCK = b'\x03\x00'
+    ''' An empty final deflate block, it ends the deflate stream of a zlib
+        frame after a full flush. '''
+
+    CODEC_ZLIB = 0
+    CODEC_NONE = 1
+    CODEC_ZSTD = 2
+    CODEC_LZ4 = 3
+
+    codecs = {
+        'zlib': CODEC_ZLIB,
+        'none': CODEC_NONE,
+        'zstd': CODEC_ZSTD,
+        'lz4': CODEC_LZ4,
+    }
+    ''' Codecs which can be used to compress the data frames. The codec id is
+        stored in bits 2-4 of the flags byte of each frame. '''
+
+    FRAME_FLAG_CHECKSUM = 0x80
+    ''' Flag of data frames which end with a CRC32 of the frame. '''
+
+    WAL_FLAG_ADD = 0x01
+    WAL_FLAG_CHECKSUM = 0x02
+    ''' Flags of WAL records, add/update (or delete) and if the record ends
+        with a CRC32 of the record. '''
+
+    compress_min_size = 256
+    ''' Data smaller than this is stored without compression. '''
+
+    durability_modes = ('none', 'flush', 'fdatasync')
+    ''' Durability modes, see `__init__()`. '''
+
+    data_file_buffer_size = 1 << 20
+    ''' Buffer size of the data file handler for appending. '''
+
+    data_file_preallocate_size = 64 << 20
+    ''' The data file is preallocated in chunks of this many bytes, so it
+        grows in few large extents. The file is truncated to the end of the
+        data on `close()`. Set to 0 to disable. '''
+
+    wal_file_buffer_size = 64 << 10
+    ''' WAL records are buffered in memory up to this many bytes, then the
+        data file is flushed and the records are written. '''
+
+    wal_checkpoint_size = 8 << 20
+    ''' The index is saved and the WAL file is restarted when it grew to this
+        many bytes, so it does not grow for the lifetime of the cache. Set to
+        0 to only do this on `close()`. '''
+
+    wal_checkpoint_min_records = 10000
+    ''' The index is also saved when the WAL file has more records than an
+        eighth of the keys, but not before it has this many records. '''
+
+    data_file_remap_size = 16 << 20
+    ''' The data file is mapped again for reading when it grew by this many
+        bytes, smaller frames past the mapping are read with `os.pread()`. '''
+
+    get_many_parallel_size = 256 << 10
+    ''' `get_many()` decompresses frames in a thread pool when they are
+        at least this many bytes in total. '''
+
+    set_many_buffer_size = 1 << 20
+    ''' `set_many()` writes the data and WAL files when this many bytes of
+        frames are buffered. '''
+
+    def __init__(self, data_file: str, auto_vacuum_threshold: float = 0.5,
+                 codec: str = 'zlib', compression_level: Optional[int] = None,
+                 durability: str = 'none', thread_safe: bool = True,
+                 compress_min_size: Optional[int] = None, value_cache_size: int = 0):
         ''' Initialize the cache with the data file.
 
             Args:
@@ -127,42 +326,191 @@ class BlobCache:
                 
                 auto_vacuum_threshold (float): The fragmentation ratio 
                     threshold for auto vacuuming. Defaults to 0.5.
+
+                codec (str): The codec used to compress new data frames, one
+                    of `zlib`, `none`, `zstd` or `lz4`. Defaults to `zlib`,
+                    which is the only codec the PHP version can write.
+
+                compression_level (int): The compression level of the codec.
+                    Defaults to 6 for `zlib` and 1 for `zstd`.
+
+                durability (str): When writes are pushed to the disk. `none`
+                    leaves it to the file buffers and the OS, `flush` flushes
+                    the file buffers after every write and `fdatasync` also
+                    syncs the files to the disk after every write. The files
+                    are always synced on `close()` and `vacuum()`. Defaults
+                    to `none`.
+
+                thread_safe (bool): With False `set()`, `get()`, `has()` and
+                    `delete()` are bound to their `_unsafe` versions, which do
+                    not lock. Only use it when the cache is used by a single
+                    thread. Defaults to True.
+
+                compress_min_size (int): Data smaller than this many bytes is
+                    stored without compression, as compressing it costs more
+                    than it saves. Defaults to 256.
+
+                value_cache_size (int): The number of recently read values
+                    which `get()` keeps in memory, so they are not read and
+                    decompressed again. Defaults to 0, which disables it.
         '''
 
+        # Lock of this cache, reentrant so a `refresh_callback` of `get()`
+        # can use the cache
+        self._thread_lock = RLock()
+
         with self._thread_lock:
 
-            self.stats = {
-                'hits': 0,
-                'sets': 0,
-                'deletes': 0,
-                'misses': 0,
-                'refreshes': 0,
-            }
+            # counters of `stats`, attributes are cheaper to update than
+            # dict items
+            self._hits = 0
+            self._sets = 0
+            self._deletes = 0
+            self._misses = 0
+            self._refreshes = 0
             self.auto_vacuum_threshold = auto_vacuum_threshold
+            self._init_codec(codec, compression_level)
+            if compress_min_size is not None:
+                self.compress_min_size = compress_min_size
+            # Decoded values by frame start, frames are never changed once
+            # written, only moved by vacuum()
+            self._value_cache = OrderedDict()
+            self._value_cache_size = value_cache_size
+            if durability not in self.durability_modes:
+                raise ValueError(f'Unknown durability `{durability}`, expected one of {list(self.durability_modes)}')
+            self.durability = durability
+            self._group_commit_depth = 0
+            # Data was written to the data file without flushing it
+            self._data_pending = False
+            # WAL records which are not written to the WAL file yet
+            self._wal_buf = bytearray()
+            # Bytes and records in the WAL file since the index was saved
+            self._wal_bytes = 0
+            self._wal_records = 0
 
             self.data_file = data_file + '.data.bin'
             self.index_file = data_file + '.index.bin'
             self.wal_file = data_file + '.wal.bin'
 
-            self.data_file_append_fd = open(self.data_file, 'ab')
+            self.data_file_append_fd = self._open_data_file()
             # Data file handler for appending
             self._lock_file_unsafe(self.data_file_append_fd)
-            _tell = self.data_file_append_fd.tell()
-            if _tell == 0:
+            data_file_size = os.fstat(self.data_file_append_fd.fileno()).st_size
+            if data_file_size == 0:
                 self._write_header_unsafe()
+                data_end = len(self.header_data_file)
             else:
-                LOG.debug('Datafile of size %d bytes is found.', _tell)
-            self.data_file_append_fd.seek(0, io.SEEK_END)  
-            # needed for PHP, so added here too
+                LOG.debug('Datafile of size %d bytes is found.', data_file_size)
+                data_end = self._find_data_end_unsafe(data_file_size)
+            self._allocated_bytes = data_file_size
 
             self.data_file_read_fd = open(self.data_file, 'rb')
-            # Data file handler for reading
+            # Data file handler for reading, frames are read from a memory
+            # map of it which is created on the first read
+            self._data_mm = None
+            self._mapped_len = 0
+            # Thread pool of get_many(), created on first use
+            self._executor = None
 
             # Load index and read WAL file is exists to the index and 
             # remove WAL file
-            self.index = self._load_index_unsafe()
+            self._load_index_unsafe()
+            if data_end < data_file_size:
+                # A crash left a preallocated tail, frames in the index which
+                # end with zero bytes must not be overwritten
+                LOG.debug('Datafile has %d preallocated bytes.', data_file_size - data_end)
+                data_end = max([data_end] + [start + length for start, length in zip(self._starts, self._lengths)])
+            # New frames are appended at the end of the data, which is
+            # tracked instead of asking the file handler with `tell()`
+            self.data_file_append_fd.seek(data_end)
+            self._data_end = data_end
             # Write-ahead log (WAL) file, open after loading index
-            self.wal_file_fd = open(self.wal_file, 'ab')
+            self.wal_file_fd = self._open_wal_file()
+
+            if not thread_safe:
+                # skip the lock and one call on every operation
+                self.set = self._set_unsafe
+                self.get = self._get_unsafe
+                self.has = self._has_unsafe
+                self.delete = self._delete_unsafe
+                self.get_many = self._get_many_unsafe
+
+            # WAL records are buffered in memory, they are written when the
+            # interpreter exits without `close()`
+            self._atexit_hook = _exit_hook(weakref.ref(self))
+            atexit.register(self._atexit_hook)
+
+    def __del__(self):
+        ''' Write a cache which is garbage collected without `close()`. '''
+        if getattr(self, 'wal_file_fd', None):
+            atexit.unregister(self._atexit_hook)
+            self._write_unclosed()
+
+    def _write_unclosed(self):
+        ''' Write the buffered data and WAL records and save the index of a
+            cache which is not closed, if it changed since the index was
+            saved. '''
+        with self._thread_lock:
+            if self.data_file_read_fd and self.wal_file_fd and self._wal_records:
+                LOG.debug('Cache is not closed, saving the index.')
+                self._checkpoint_unsafe()
+
+    def _open_data_file(self):
+        ''' Open the data file for appending. It is not opened in append mode,
+            as frames are written at the end of the data and not at the end
+            of the preallocated file. '''
+        fd = os.open(self.data_file, os.O_RDWR | os.O_CREAT, 0o666)
+        return open(fd, 'r+b', buffering=self.data_file_buffer_size)
+
+    def _open_wal_file(self):
+        ''' Open the write-ahead log (WAL) file for appending, with
+            `O_APPEND` every write is appended atomically. '''
+        fd = os.open(self.wal_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        return os.fdopen(fd, 'ab', buffering=self.wal_file_buffer_size)
+
+    def _find_data_end_unsafe(self, data_file_size: int) -> int:
+        ''' Return the end of the data in the data file, skipping the zero
+            bytes of a preallocated tail which was not truncated. '''
+        fd = self.data_file_append_fd.fileno()
+        header_size = len(self.header_data_file)
+        end = data_file_size
+        # comparing with zero bytes is much faster than rstrip(), which is
+        # only used on the chunk with the end of the data
+        zeros = bytes(1 << 16)
+        while end > header_size:
+            size = min(end - header_size, 1 << 16)
+            chunk = os.pread(fd, size, end - size)
+            if chunk != zeros[:size]:
+                return end - size + len(chunk.rstrip(b'\0'))
+            end -= size
+        return header_size
+
+    def _init_codec(self, codec: str, compression_level: Optional[int]):
+        ''' Select the codec for new data frames. Compressor instances are
+            created once here as their construction is expensive. '''
+        if codec not in self.codecs:
+            raise ValueError(f'Unknown codec `{codec}`, expected one of {list(self.codecs)}')
+        self._codec = self.codecs[codec]
+        self._compression_level = compression_level
+        self._zstd_compressor = None
+        self._zlib_compressor = None
+        # zstd decompressors can not be shared between threads
+        self._thread_local = local()
+        if self._codec == self.CODEC_ZLIB:
+            if compression_level is None:
+                self._compression_level = 6
+            # Raw deflate context which is reused for every frame, the zlib
+            # header is taken from an empty stream of the same level
+            self._zlib_compressor = zlib.compressobj(self._compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self._zlib_header = zlib.compress(b'', self._compression_level)[:2]
+        elif self._codec == self.CODEC_ZSTD:
+            if zstandard is None:
+                raise ImportError('Codec `zstd` requires the `zstandard` package')
+            self._zstd_compressor = zstandard.ZstdCompressor(level=compression_level or 1)
+        elif self._codec == self.CODEC_LZ4 and lz4 is None:
+            raise ImportError('Codec `lz4` requires the `lz4` package')
+        # Fast deflate context used to probe if data is worth compressing
+        self._probe_compressor = zlib.compressobj(1)
 
     def _is_locked_unsafe(self, fd=None, keep_locked=False):
         ''' Check if the cache data file is locked. '''
@@ -192,255 +540,815 @@ class BlobCache:
         fcntl.flock(fd, fcntl.LOCK_UN)
         LOG.debug("Lock released on file.")
 
-    def _load_index_unsafe(self) -> dict:
+    def _reset_index_unsafe(self):
+        ''' Create an empty index. The index is stored as a struct of arrays,
+            `_key_slot` maps a key, encoded as UTF-8 bytes, to a slot in the
+            `_starts`, `_lengths` and
+            `_expires` arrays. Slots of deleted keys have length 0 and are
+            reused by new keys. `_live_bytes` is the total length of the
+            frames in the index.
+
+            `_sorted_keys` is a sorted list of the keys for prefix searches,
+            built on the first `delete_startswith()`. New keys are collected
+            in `_unsorted_keys` until the next search and deleted keys are
+            only removed from it by `delete_startswith()`. '''
+        self._key_slot = {}
+        self._starts = array('Q')
+        self._lengths = array('I')
+        self._expires = array('I')
+        self._free_slots = []
+        self._live_bytes = 0
+        self._sorted_keys = None
+        self._unsorted_keys = []
+
+    def _index_put_unsafe(self, key: bytes, start: int, length: int, expires: int):
+        ''' Add or update a key in the index. '''
+        slot = self._key_slot.get(key)
+        if slot is None:
+            if self._sorted_keys is not None:
+                self._unsorted_keys.append(key)
+            if not self._free_slots:
+                # new slot at the end of the arrays, the key is added when
+                # all values are, so the arrays stay the same length
+                slot = len(self._starts)
+                try:
+                    self._starts.append(start)
+                    self._lengths.append(length)
+                    self._expires.append(expires)
+                except OverflowError:
+                    del self._starts[slot:], self._lengths[slot:], self._expires[slot:]
+                    raise
+                self._key_slot[key] = slot
+                self._live_bytes += length
+                return
+            slot = self._free_slots[-1]
+            self._starts[slot] = start
+            self._lengths[slot] = length
+            self._expires[slot] = expires
+            self._free_slots.pop()
+            self._key_slot[key] = slot
+            self._live_bytes += length
+            return
+        self._live_bytes += length - self._lengths[slot]
+        self._starts[slot] = start
+        self._lengths[slot] = length
+        self._expires[slot] = expires
+
+    def _index_remove_unsafe(self, key: bytes):
+        ''' Remove a key from the index if it exists and free its slot. '''
+        slot = self._key_slot.pop(key, None)
+        if slot is not None:
+            self._live_bytes -= self._lengths[slot]
+            self._starts[slot] = 0
+            self._lengths[slot] = 0
+            self._expires[slot] = 0
+            self._free_slots.append(slot)
+
+    def _map_file(self, filename: str) -> Optional[mmap.mmap]:
+        ''' Map a file in memory for reading. Returns None if the file does
+            not exist or is empty, as empty files can not be mapped. '''
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_index_unsafe(self):
         ''' Load the index from the index file and the write-ahead log (WAL) file
-            if it exists. Then return the index and remove the WAL file. '''
-        index = {}
+            if it exists. Then remove the WAL file. Both files are mapped in
+            memory and parsed in place. '''
+        self._reset_index_unsafe()
         now = time.time()
+        unpack_key_length = self._S_I.unpack_from
+        size_key_length = self._S_I.size
+        unpack_index = self._S_ENTRY.unpack_from
+        size_index = self._S_ENTRY.size
+        index_put = self._index_put_unsafe
+        index_remove = self._index_remove_unsafe
         LOG.debug("Loading index file...")
-        if os.path.exists(self.index_file):
-            with open(self.index_file, 'rb') as f:
-                while True:
-                    key_length_bytes = f.read(struct.calcsize('I'))
-                    if not key_length_bytes:
+        mm = self._map_file(self.index_file)
+        if mm is not None:
+            with mm:
+                end = len(mm)
+                offset = 0
+                while offset + size_key_length <= end:
+                    key_length = unpack_key_length(mm, offset)[0]
+                    offset += size_key_length
+                    key = mm[offset:offset + key_length]
+                    offset += key_length
+                    if offset + size_index > end:
                         break
-                    key_length = struct.unpack('I', key_length_bytes)[0]
-                    key = f.read(key_length).decode('utf-8')
-                    entry_data = f.read(struct.calcsize(self.pack_format_index))
-                    start, length, expires = struct.unpack(self.pack_format_index, entry_data)
+                    start, length, expires = unpack_index(mm, offset)
+                    offset += size_index
                     if expires == 0 or expires > now:
-                        index[key] = {
-                            'start': start,
-                            'length': length,
-                            'expires': expires,
-                        }
+                        index_put(key, start, length, expires)
 
         if os.path.exists(self.wal_file):
-            with open(self.wal_file, 'rb') as f:
+            # With buffered writes a crash can leave WAL records which point
+            # beyond the end of the data file or into its preallocated tail,
+            # those are skipped
+            data_file_size = os.path.getsize(self.data_file)
+            data_end = self._find_data_end_unsafe(data_file_size)
+            crc32 = zlib.crc32
+            unpack_crc = self._S_I.unpack_from
+            size_crc = self._S_I.size
+            flag_add = self.WAL_FLAG_ADD
+            flag_checksum = self.WAL_FLAG_CHECKSUM
+            mm = self._map_file(self.wal_file)
+            if mm is not None:
                 LOG.debug("...processing WAL file...")
-                while True:
-                    key_length_bytes = f.read(4)
-                    if len(key_length_bytes) < 4:
-                        break
-                    key_length = struct.unpack('I', key_length_bytes)[0]
-                    key = f.read(key_length).decode('utf-8')
-                    # check if entry is deleted or not
-                    entry_flag = struct.unpack('?', f.read(1))[0]
-                    if entry_flag:
-                        entry_data = f.read(struct.calcsize(self.pack_format_index))
-                        start, length, expires = struct.unpack(self.pack_format_index, entry_data)
-                        if expires == 0 or expires > now:
-                            entry = {
-                                'start': start,
-                                'length': length,
-                                'expires': expires,
-                            }
-                            index[key] = entry
-                    else:
-                        if key in index:
-                            del index[key]
-            # TODO BUG FIXME: best is self._save_index() after loading of the WAL file so we know it is saved as now it's possible to loose data from the WAL is BLOB crashes
-            os.remove(self.wal_file)
+                with mm:
+                    end = len(mm)
+                    offset = 0
+                    while offset + size_key_length <= end:
+                        # partial records at the end of the WAL file, left
+                        # by a crash, end the replay
+                        record_start = offset
+                        key_length = unpack_key_length(mm, offset)[0]
+                        offset += size_key_length
+                        if offset + key_length + 1 > end:
+                            break
+                        key = mm[offset:offset + key_length]
+                        offset += key_length
+                        # check if entry is deleted or not
+                        entry_flag = mm[offset]
+                        offset += 1
+                        entry = None
+                        if entry_flag & flag_add:
+                            if offset + size_index > end:
+                                break
+                            entry = unpack_index(mm, offset)
+                            offset += size_index
+                        if entry_flag & flag_checksum:
+                            if offset + size_crc > end:
+                                break
+                            if crc32(mm[record_start:offset]) != unpack_crc(mm, offset)[0]:
+                                LOG.warning('WAL record at offset %d is corrupted, replay stopped.', record_start)
+                                break
+                            offset += size_crc
+                        if entry is not None:
+                            start, length, expires = entry
+                            if start >= data_end or start + length > data_file_size:
+                                LOG.warning('WAL entry for key `%s` points beyond the data file, skipped.', key)
+                                index_remove(key)
+                            elif expires == 0 or expires > now:
+                                index_put(key, start, length, expires)
+                            else:
+                                index_remove(key)
+                        else:
+                            index_remove(key)
+            # the replayed entries are saved before the WAL file is removed
+            self._save_index_unsafe()
 
-        LOG.debug('...index loaded with %d keys.', len(index))
-        return index
+        LOG.debug('...index loaded with %d keys.', len(self._key_slot))
 
-    def _append_to_wal_file_unsafe(self, key: str, entry: Optional[dict]):
+    def _append_to_wal_file_unsafe(self, key: bytes, entry: Optional[tuple]):
         ''' Append an entry to the write-ahead log (WAL) file. '''
-        buf = []
-        key_bytes = key.encode('utf-8')
+        self._wal_buf += self._build_wal_record(key, entry)
+        self._wal_records += 1
+        if len(self._wal_buf) >= self.wal_file_buffer_size:
+            self._flush_pending_unsafe()
+        if self._wal_records > self.wal_checkpoint_min_records or self._wal_bytes >= self.wal_checkpoint_size:
+            self._maybe_checkpoint_unsafe()
+        self._maybe_sync_unsafe()
+
+    def _maybe_checkpoint_unsafe(self):
+        ''' Save the index and restart the WAL file when it is larger than
+            `wal_checkpoint_size` or has more records than an eighth of the
+            keys. '''
+        size = self.wal_checkpoint_size
+        if not size:
+            return
+        if (self._wal_bytes + len(self._wal_buf) >= size
+                or self._wal_records > max(len(self._key_slot) >> 3, self.wal_checkpoint_min_records)):
+            LOG.debug('Checkpoint of %d WAL records.', self._wal_records)
+            self._checkpoint_unsafe()
+
+    def _checkpoint_unsafe(self):
+        ''' Save the index and start a new WAL file. The data file is synced
+            first, so the index never points to data which is not on the
+            disk. If the index cannot be saved, the WAL file is reopened and
+            keeps its records. '''
+        self._sync_unsafe()
+        self.wal_file_fd.close()
+        try:
+            self._save_index_unsafe()
+        finally:
+            self.wal_file_fd = self._open_wal_file()
+
+    def _build_wal_record(self, key: bytes, entry: Optional[tuple]) -> bytearray:
+        ''' Build a write-ahead log (WAL) record, `entry` is a (start, length,
+            expires) tuple or None for deleted keys. '''
+        key_length = len(key)
+        # the record is packed into one buffer of the final size
+        offset = 4 + key_length
+        size = offset + 1 + (0 if entry is None else self._S_ENTRY.size)
+        record = bytearray(size + 4)
         # key length int
-        key_length = len(key_bytes)
-        buf.append(struct.pack('I', key_length))
+        self._S_I.pack_into(record, 0, key_length)
         # key bytes
-        buf.append(key_bytes)
+        record[4:offset] = key
         if entry is None:
             # entry deleted
-            buf.append(struct.pack('?', False))
+            record[offset] = self.WAL_FLAG_CHECKSUM
         else:
-            # entry added or updated
-            buf.append(struct.pack('?', True))
-            buf.append(struct.pack(self.pack_format_index, entry['start'], entry['length'], entry['expires']))
-
-        self.wal_file_fd.write(b''.join(buf))
-        self.wal_file_fd.flush()
+            # entry added or updated, flags and entry are packed at once
+            self._S_WAL_ADD.pack_into(record, offset, self.WAL_FLAG_ADD | self.WAL_FLAG_CHECKSUM, *entry)
+        # checksum of the record
+        self._S_I.pack_into(record, size, zlib.crc32(memoryview(record)[:size]))
+        return record
 
     def _save_index_unsafe(self):
         ''' Save the index to the index file and remove the WAL file. '''
         tmp_index_file = self.index_file + '.tmp'
         with open(tmp_index_file, 'wb') as f:
             LOG.debug("Saving index file...")
-            for key, entry in self.index.items():
-                buf = []
-                key_bytes = key.encode('utf-8')
-                key_length = len(key_bytes)
-                buf.append(struct.pack('I', key_length))
-                buf.append(key_bytes)
-                buf.append(struct.pack(self.pack_format_index, entry['start'], entry['length'], entry['expires']))
-                f.write(b''.join(buf))
+            pack_key_length = self._S_I.pack
+            pack_index = self._S_ENTRY.pack
+            starts, lengths, expires = self._starts, self._lengths, self._expires
+            # the entries are collected in one buffer and written at once
+            buf = bytearray()
+            for key, slot in self._key_slot.items():
+                buf += pack_key_length(len(key))
+                buf += key
+                buf += pack_index(starts[slot], lengths[slot], expires[slot])
+            f.write(buf)
+            f.flush()
+            _fdatasync(f.fileno())
         os.replace(tmp_index_file, self.index_file)
         if os.path.exists(self.wal_file):
             os.remove(self.wal_file)
+        self._wal_bytes = 0
+        self._wal_records = 0
 
     def _write_header_unsafe(self):
         ''' Write the header of the data file. '''
         self.data_file_append_fd.write(self.header_data_file)
 
-    def _get_compressed_data(self, data: bytes):
-        ''' Compress data using zlib. '''
-        return zlib.compress(data, 6)
-
-    def _append_frame_to_data_file_unsafe(self, key: str, expires:int, is_bytes: int, data: bytes) -> tuple:
+    def _is_compressible(self, data: bytes) -> bool:
+        ''' Guess if data is worth compressing. Small data is never
+            compressed and for larger data a sample is compressed with the
+            fastest deflate level to detect random or already compressed
+            data. '''
+        if len(data) < self.compress_min_size:
+            return False
+        sample = data[:512]
+        probe = self._probe_compressor.compress(sample) + self._probe_compressor.flush(zlib.Z_FULL_FLUSH)
+        return len(probe) < len(sample) * 0.95
+
+    def _compress_data(self, data: bytes) -> tuple:
+        ''' Compress data using the selected codec. Returns the codec id which
+            was actually used and the compressed data. '''
+        if self._codec == self.CODEC_NONE or not self._is_compressible(data):
+            return self.CODEC_NONE, data
+        if self._codec == self.CODEC_ZSTD:
+            return self.CODEC_ZSTD, self._zstd_compressor.compress(data)
+        if self._codec == self.CODEC_LZ4:
+            return self.CODEC_LZ4, lz4.frame.compress(data, compression_level=self._compression_level or 0)
+        return self.CODEC_ZLIB, self._compress_zlib(data)
+
+    def _compress_zlib(self, data: bytes) -> bytes:
+        ''' Compress data to a zlib stream with the reused deflate context,
+            which saves setting up a new one for every frame. The full flush
+            resets the context, so every frame is a complete zlib stream which
+            `zlib.decompress()` and `gzuncompress()` in PHP can read. '''
+        compressor = self._zlib_compressor
+        return b''.join((
+            self._zlib_header,
+            compressor.compress(data),
+            compressor.flush(zlib.Z_FULL_FLUSH),
+            self._ZLIB_FINAL_BLOCK,
+            self._S_ADLER32.pack(zlib.adler32(data)),
+        ))
+
+    def _build_frame(self, data: bytes, is_bytes: int) -> bytes:
+        ''' Compress data and build a data frame from it. '''
+        if len(data) < self.compress_min_size:
+            # small data is never compressed, which is the common case of
+            # small JSON values, so the codec is not looked at
+            codec, compressed_data = self.CODEC_NONE, data
+        else:
+            codec, compressed_data = self._compress_data(data)
+        # flags byte, value type in bits 0-1, codec in bits 2-4 and checksum
+        # flag in bit 7, and the length of compressed data, packed at once
+        header = self._S_HDR.pack(is_bytes | (codec << 2) | self.FRAME_FLAG_CHECKSUM, len(compressed_data))
+        # the compressed data and the checksum of the header and the
+        # compressed data
+        return b''.join((header, compressed_data, self._S_I.pack(zlib.crc32(compressed_data, zlib.crc32(header)))))
+
+    def _append_frame_to_data_file_unsafe(self, key: bytes, expires:int, is_bytes: int, data: bytes) -> tuple:
         ''' Append data to the data file and return the start position and length
-            of the compressed data.'''
-        buf = []
-        # is_bytes struct int
-        buf.append(struct.pack('B', is_bytes))
-        # data bytes
-        start = self.data_file_append_fd.tell()
-        compressed_data = zlib.compress(data, 6)
-        # length of gzipped data
-        buf.append(struct.pack('I', len(compressed_data)))
-        # append the compressed data
-        buf.append(compressed_data)
-        # write data to file
-        self.data_file_append_fd.write(b''.join(buf))
+            of the data frame.'''
+        start = self._data_end
+        frame = self._build_frame(data, is_bytes)
+        if len(frame) > self._MAX_UINT32:
+            raise ValueError(f'Value of key `{key}` is too large, the frame is {len(frame)} bytes')
+        end = self._data_end = start + len(frame)
+        if end > self._allocated_bytes:
+            self._preallocate_unsafe(end)
+        # write data to file, it is flushed together with the WAL file
+        self.data_file_append_fd.write(frame)
+        self._data_pending = True
+        return start, len(frame)
+
+    def _preallocate_unsafe(self, end: int):
+        ''' Preallocate the data file beyond `end` in chunks of
+            `data_file_preallocate_size` bytes. '''
+        size = self.data_file_preallocate_size
+        if not size or _posix_fallocate is None:
+            self._allocated_bytes = end
+            return
+        length = (end - self._allocated_bytes) // size * size + size
+        try:
+            _posix_fallocate(self.data_file_append_fd.fileno(), self._allocated_bytes, length)
+        except OSError as e:
+            LOG.debug('Preallocating the data file failed, disabled: %s', e)
+            self.data_file_preallocate_size = 0
+            self._allocated_bytes = end
+            return
+        self._allocated_bytes += length
+
+    def _truncate_data_file_unsafe(self):
+        ''' Remove the preallocated tail of the data file. '''
         self.data_file_append_fd.flush()
-        end = self.data_file_append_fd.tell()
-        return start, end - start
+        self._data_pending = False
+        end = self._data_end
+        if self._allocated_bytes > end:
+            os.ftruncate(self.data_file_append_fd.fileno(), end)
+            self._allocated_bytes = end
+
+    def _flush_pending_unsafe(self):
+        ''' Flush buffered writes, the data file first so the WAL never
+            points to data which is not written yet. '''
+        self.data_file_append_fd.flush()
+        self._data_pending = False
+        if self._wal_buf:
+            self.wal_file_fd.write(self._wal_buf)
+            self._wal_bytes += len(self._wal_buf)
+            self._wal_buf.clear()
+        self.wal_file_fd.flush()
 
-    def _read_frame_from_data_file_unsafe(self, start: int):
+    def _maybe_sync_unsafe(self):
+        ''' Flush and sync the files after a write as the durability mode
+            requires. Nothing is done within `group_commit()`. '''
+        if self._group_commit_depth or self.durability == 'none':
+            return
+        self._flush_pending_unsafe()
+        if self.durability == 'fdatasync':
+            _fdatasync(self.data_file_append_fd.fileno())
+            _fdatasync(self.wal_file_fd.fileno())
+
+    def _sync_unsafe(self):
+        ''' Flush buffered writes and sync the data and WAL files to the disk. '''
+        self._flush_pending_unsafe()
+        _fdatasync(self.data_file_append_fd.fileno())
+        _fdatasync(self.wal_file_fd.fileno())
+
+    def flush_pending(self):
+        ''' Thread safe version of self._flush_pending(). '''
+        with self._thread_lock:
+            return self._flush_pending_unsafe()
+
+    def sync(self):
+        ''' Thread safe version of self._sync(). '''
+        with self._thread_lock:
+            return self._sync_unsafe()
+
+    @contextmanager
+    def group_commit(self):
+        ''' Context manager which postpones flushing of the data and WAL files
+            until the end of the block, use it for bulk loads. With the
+            `fdatasync` durability mode the files are also synced then. '''
+        with self._thread_lock:
+            self._group_commit_depth += 1
+        try:
+            yield self
+        finally:
+            with self._thread_lock:
+                self._group_commit_depth -= 1
+                if not self._group_commit_depth:
+                    if self.durability == 'fdatasync':
+                        self._sync_unsafe()
+                    else:
+                        self._flush_pending_unsafe()
+
+    def _remap_data_file_unsafe(self):
+        ''' Map the data file in memory for reading, replacing the old map. '''
+        if self._data_mm is not None:
+            self._data_mm.close()
+        self._data_mm = mmap.mmap(self.data_file_read_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        # the preallocated tail is mapped too, but only the flushed data
+        # can be read from it
+        self._mapped_len = min(len(self._data_mm), self._data_end)
+
+    def _unmap_data_file_unsafe(self):
+        ''' Close the memory map of the data file. '''
+        if self._data_mm is not None:
+            self._data_mm.close()
+            self._data_mm = None
+        self._mapped_len = 0
+
+    def _read_raw_frame_unsafe(self, start: int, length: int) -> bytes:
+        ''' Return the bytes of a data frame. Frames are sliced from the memory
+            map of the data file, which is extended when the file grew enough
+            since it was mapped. '''
+        end = start + length
+        if end > self._mapped_len:
+            if self._data_pending:
+                # make buffered frames visible to the read file handler
+                self.data_file_append_fd.flush()
+                self._data_pending = False
+            if self._data_mm is not None and end <= len(self._data_mm):
+                # the frame was written to the mapped preallocated tail
+                self._mapped_len = min(len(self._data_mm), self._data_end)
+            elif self._data_mm is None or os.fstat(self.data_file_read_fd.fileno()).st_size - self._mapped_len >= self.data_file_remap_size:
+                self._remap_data_file_unsafe()
+            if end > self._mapped_len:
+                return os.pread(self.data_file_read_fd.fileno(), length, start)
+        return self._data_mm[start:end]
+
+    def _read_frame_from_data_file_unsafe(self, start: int, length: int):
         ''' Read a frame from the data file. '''
-        data = None
-        self.data_file_read_fd.seek(start)
-        # read is_bytes (int)
-        is_bytes = struct.unpack('B',self.data_file_read_fd.read(struct.calcsize('B')))[0]
-        # read data length (int - long long)
-        data_length = struct.unpack('I',self.data_file_read_fd.read(struct.calcsize('I')))[0]
-        # read data
-        compressed_data = self.data_file_read_fd.read(data_length)
-        data = self._decompress_data(compressed_data)
+        return self._decode_frame(self._read_raw_frame_unsafe(start, length))
+
+    def _read_cached_value_unsafe(self, start: int, length: int):
+        ''' Read a frame from the data file through the value cache, which
+            keeps the last `value_cache_size` values. JSON values are kept as
+            JSON and decoded on every read, as the caller can change them. '''
+        cache = self._value_cache
+        cached = cache.get(start)
+        if cached is None:
+            is_bytes, data = self._decompress_frame(self._read_raw_frame_unsafe(start, length))
+            cached = (is_bytes, data if is_bytes == 0 else self._decode_value(is_bytes, data))
+            cache[start] = cached
+            if len(cache) > self._value_cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(start)
+        is_bytes, value = cached
+        return _json_loads(value) if is_bytes == 0 else value
+
+    def _decode_frame(self, frame: bytes):
+        ''' Decompress and decode the value of a data frame. This does not
+            touch the files or the index, so it is safe without locking. '''
+        return self._decode_value(*self._decompress_frame(frame))
+
+    def _decompress_frame(self, frame: bytes) -> tuple:
+        ''' Check and decompress a data frame. Returns the value type and
+            the decompressed data. '''
+        # read the header, flags (int) and data length (int) at once. The
+        # value type is in bits 0-1 of the flags and the codec in bits 2-4
+        flags, data_length = self._S_HDR.unpack_from(frame)
+        is_bytes = flags & 0x03
+        codec = (flags >> 2) & 0x07
+        # read data, without copying it again
+        size_header = self._S_HDR.size
+        end = size_header + data_length
+        view = memoryview(frame)
+        if flags & self.FRAME_FLAG_CHECKSUM:
+            if zlib.crc32(view[:end]) != self._S_I.unpack_from(frame, end)[0]:
+                raise ValueError('Data frame is corrupted, checksum mismatch')
+        compressed_data = view[size_header:end]
+        return is_bytes, self._decompress_data(compressed_data, codec)
+
+    def _decode_value(self, is_bytes: int, data: bytes):
+        ''' Decode decompressed data of the given value type. '''
         if is_bytes == 0:
-            data = json.loads(data)
+            return _json_loads(data)
+        if is_bytes == 2:
+            return data.decode('utf-8', 'surrogatepass')
         return data
 
-    def _decompress_data(self, compressed_data: bytes):
-        ''' Decompress data using zlib. '''
-        return zlib.decompress(compressed_data)
-
-    def set_on_miss(self, key: str, value: Union[str, set, dict, list, int, float, bool, bytes], ttl: Optional[int] = None):
+    def _decompress_data(self, compressed_data: Union[bytes, memoryview], codec: int = CODEC_ZLIB):
+        ''' Decompress data using the codec the frame was written with. '''
+        if codec == self.CODEC_ZLIB:
+            return zlib.decompress(compressed_data)
+        if codec == self.CODEC_NONE:
+            return bytes(compressed_data)
+        if codec == self.CODEC_ZSTD:
+            decompressor = getattr(self._thread_local, 'zstd_decompressor', None)
+            if decompressor is None:
+                if zstandard is None:
+                    raise ImportError('Data frame is compressed with `zstd`, which requires the `zstandard` package')
+                decompressor = self._thread_local.zstd_decompressor = zstandard.ZstdDecompressor()
+            return decompressor.decompress(compressed_data)
+        if codec == self.CODEC_LZ4:
+            if lz4 is None:
+                raise ImportError('Data frame is compressed with `lz4`, which requires the `lz4` package')
+            return lz4.frame.decompress(compressed_data)
+        raise ValueError(f'Unknown codec id {codec} in data frame')
+
+    def set_on_miss(self, key: Union[str, bytes], value: Union[str, set, dict, list, int, float, bool, bytes], ttl: Optional[int] = None):
         ''' Set a key in the cache only if this key is not found in cache.
             The value can be a string, set, dict, list, int, float, bool or bytes. '''
+        if isinstance(key, str):
+            key = key.encode('utf-8')
         with self._thread_lock:
             if not self._has_unsafe(key):
                 self._set_unsafe(key, value, ttl)
 
-    def set(self, key: str, value: Union[str, set, dict, list, int, float, bool, bytes], ttl: Optional[int] = None):
+    def set(self, key: Union[str, bytes], value: Union[str, set, dict, list, int, float, bool, bytes], ttl: Optional[int] = None):
         ''' Thread safe version of self._set(). '''
         with self._thread_lock:
             return self._set_unsafe(key, value, ttl)
 
-    def _set_unsafe(self, key: str, value: Union[str, set, dict, list, int, float, bool, bytes], ttl: Optional[int] = None):
+    def _set_unsafe(self, key: Union[str, bytes], value: Union[str, set, dict, list, int, float, bool, bytes], ttl: Optional[int] = None):
         ''' Set a key in the cache. The value can be a string, set, dict, list,
             int, float, bool or bytes without locking. '''
-        assert isinstance(key, str), 'Key must be a string'
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        assert isinstance(key, bytes), 'Key must be a string or bytes'
         assert self.data_file_read_fd, 'Cache is closed'
-        if isinstance(value, bytes):
-            data = value
-            is_bytes = 1
-        elif isinstance(value, (bool, tuple, str, set, dict, list, int, float, bool)):
-            data = json.dumps(value).encode()
-            is_bytes = 0
-        else:
-            raise ValueError(f'Value must be bytes or JSON-serializable, given {type(value)}')
+        is_bytes, data = self._encode_value(value)
 
         expires = int(time.time() + ttl) if ttl else 0
+        if not 0 <= expires <= self._MAX_UINT32:
+            raise ValueError(f'TTL {ttl} is out of range')
 
         start, length = self._append_frame_to_data_file_unsafe(key, expires, is_bytes, data)
 
-        entry = {
-            'start': start,
-            'length': length,   # this is kept for faster fragmentation calculation
-            'expires': expires,
-            'is_bytes': is_bytes,
-        }
-        self.index[key] = entry
-        self._append_to_wal_file_unsafe(key, entry)
+        # length is kept for faster fragmentation calculation
+        self._index_put_unsafe(key, start, length, expires)
+        self._append_to_wal_file_unsafe(key, (start, length, expires))
 
-        self.stats['sets'] += 1
+        self._sets += 1
 
-    def get(self, key: str, refresh_callback: Optional[Callable[[str], Union[str, dict]]] = None, new_ttl: Optional[int] = None):
-        ''' Thread safe version of self._get(). '''
+    def _encode_value(self, value: Union[str, set, dict, list, int, float, bool, bytes]) -> tuple:
+        ''' Return the value type and the data to store for a value. '''
+        if isinstance(value, str):
+            # stored as is, surrogates are kept like json does
+            return 2, value.encode('utf-8', 'surrogatepass')
+        if isinstance(value, bytes):
+            return 1, value
+        if isinstance(value, (bool, tuple, set, dict, list, int, float, bool)):
+            return 0, _json_dumps(value)
+        raise ValueError(f'Value must be bytes or JSON-serializable, given {type(value)}')
+
+    def set_many(self, items: Union[dict, Iterable[tuple]], ttl: Optional[int] = None):
+        ''' Thread safe version of self._set_many(). '''
         with self._thread_lock:
-            return self._get_unsafe(key, refresh_callback, new_ttl)
+            return self._set_many_unsafe(items, ttl)
+
+    def _set_many_unsafe(self, items: Union[dict, Iterable[tuple]], ttl: Optional[int] = None):
+        ''' Set multiple keys in the cache. `items` is a dict or an iterable
+            of (key, value) pairs. The frames and WAL records are buffered and
+            written with one write per file for every `set_many_buffer_size`
+            bytes of frames. '''
+        assert self.data_file_read_fd, 'Cache is closed'
+        if isinstance(items, dict):
+            items = items.items()
 
-    def _get_unsafe(self, key: str, refresh_callback: Optional[Callable[[str], Union[str, dict]]] = None, new_ttl: Optional[int] = None):
+        expires = int(time.time() + ttl) if ttl else 0
+        if not 0 <= expires <= self._MAX_UINT32:
+            raise ValueError(f'TTL {ttl} is out of range')
+        offset = self._data_end
+        frames = bytearray()
+        entries = []
+        for key, value in items:
+            if isinstance(key, str):
+                key = key.encode('utf-8')
+            assert isinstance(key, bytes), 'Key must be a string or bytes'
+            is_bytes, data = self._encode_value(value)
+            frame = self._build_frame(data, is_bytes)
+            if len(frame) > self._MAX_UINT32:
+                raise ValueError(f'Value of key `{key}` is too large, the frame is {len(frame)} bytes')
+            entries.append((key, (offset + len(frames), len(frame), expires)))
+            frames += frame
+            if len(frames) >= self.set_many_buffer_size:
+                self._write_many_unsafe(frames, entries)
+                offset = self._data_end
+                frames = bytearray()
+                entries = []
+        if entries:
+            self._write_many_unsafe(frames, entries)
+
+    def _write_many_unsafe(self, frames: bytearray, entries: list):
+        ''' Write buffered frames to the data file, then add the entries to
+            the index and the WAL file. '''
+        end = self._data_end = self._data_end + len(frames)
+        if end > self._allocated_bytes:
+            self._preallocate_unsafe(end)
+        self.data_file_append_fd.write(frames)
+        self._data_pending = True
+        wal = self._wal_buf
+        for key, entry in entries:
+            self._index_put_unsafe(key, *entry)
+            wal += self._build_wal_record(key, entry)
+        self._sets += len(entries)
+        self._wal_records += len(entries)
+        if len(wal) >= self.wal_file_buffer_size:
+            self._flush_pending_unsafe()
+        if self._wal_records > self.wal_checkpoint_min_records or self._wal_bytes >= self.wal_checkpoint_size:
+            self._maybe_checkpoint_unsafe()
+        self._maybe_sync_unsafe()
+
+    def get(self, key: Union[str, bytes], refresh_callback: Optional[Callable[[str], Union[str, dict]]] = None, new_ttl: Optional[int] = None):
+        ''' Thread safe version of self._get(). The frame is copied from the
+            data file with the lock held, then decompressed without it. '''
+        with self._thread_lock:
+            frame = None if self._value_cache_size else self._get_frame_unsafe(key)
+            if frame is None:
+                # misses and the value cache are handled with the lock held
+                return self._get_unsafe(key, refresh_callback, new_ttl)
+        return self._decode_frame(frame)
+
+    def _get_frame_unsafe(self, key: Union[str, bytes]) -> Optional[bytes]:
+        ''' Return the raw data frame of a key which is found and not
+            expired, or None. '''
+        assert self.data_file_read_fd, 'Cache is closed'
+        slot = self._key_slot.get(key.encode('utf-8') if isinstance(key, str) else key)
+        if slot is not None:
+            expires = self._expires[slot]
+            if not expires or expires >= time.time():
+                self._hits += 1
+                return self._read_raw_frame_unsafe(self._starts[slot], self._lengths[slot])
+        return None
+
+    def _get_unsafe(self, key: Union[str, bytes], refresh_callback: Optional[Callable[[str], Union[str, dict]]] = None, new_ttl: Optional[int] = None):
         ''' Get a key from the cache. If the key is expired, the `refresh_callback`
             is called and its return value is stored in the cache with the new TTL.
             '''
-        assert isinstance(key, str), 'Key must be a string'
         assert self.data_file_read_fd, 'Cache is closed'
+        key_bytes = key.encode('utf-8') if isinstance(key, str) else key
 
-        # has key and not expired
-        if self._has_unsafe(key):
-            self.stats['hits'] += 1
-            entry = self.index[key]
-            return self._read_frame_from_data_file_unsafe(entry['start'])
+        # has key and not expired, like `_has_unsafe()` with one lookup
+        slot = self._key_slot.get(key_bytes)
+        if slot is not None:
+            expires = self._expires[slot]
+            if not expires or expires >= time.time():
+                self._hits += 1
+                if self._value_cache_size:
+                    return self._read_cached_value_unsafe(self._starts[slot], self._lengths[slot])
+                return self._read_frame_from_data_file_unsafe(self._starts[slot], self._lengths[slot])
 
-        self.stats['misses'] += 1
+        self._misses += 1
 
         if refresh_callback:
             # key is expired or not found, refresh...
-            self.stats['refreshes'] += 1
+            self._refreshes += 1
             value = refresh_callback(key)
-            self._set_unsafe(key, value, ttl=new_ttl)
+            self._set_unsafe(key_bytes, value, ttl=new_ttl)
             return value
 
         # key is not found or expired and no refresh callback
         raise KeyError(f'Key `{key}` is not found or expired')
 
-    def has(self, key: str) -> bool:
+    def get_many(self, keys: Iterable[Union[str, bytes]]) -> dict:
+        ''' Get multiple keys from the cache. Returns a dict with the keys which
+            are found and not expired. The frames are copied from the data
+            file with the lock held, then decompressed without it. Large
+            batches are decompressed in a thread pool, zlib releases the GIL
+            while it works. '''
+        workers = os.cpu_count() or 1
+        with self._thread_lock:
+            frames = self._get_many_frames_unsafe(keys)
+            executor = None
+            if workers > 1 and sum(len(frame) for frame in frames.values()) >= self.get_many_parallel_size:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=workers)
+                executor = self._executor
+        if executor is None:
+            return {key: self._decode_frame(frame) for key, frame in frames.items()}
+        # one task per worker, a task per frame costs more than it saves
+        items = list(frames.items())
+        size = -(-len(items) // workers)
+        chunks = [items[i:i + size] for i in range(0, len(items), size)]
+        result = {}
+        for decoded in executor.map(self._decode_frames, chunks):
+            result.update(decoded)
+        return result
+
+    def _decode_frames(self, items: list) -> dict:
+        ''' Decode a list of (key, frame) pairs, see `get_many()`. '''
+        return {key: self._decode_frame(frame) for key, frame in items}
+
+    def _get_many_unsafe(self, keys: Iterable[Union[str, bytes]]) -> dict:
+        ''' Get multiple keys from the cache without a thread pool, see
+            `get_many()`. '''
+        frames = self._get_many_frames_unsafe(keys)
+        return {key: self._decode_frame(frame) for key, frame in frames.items()}
+
+    def _get_many_frames_unsafe(self, keys: Iterable[Union[str, bytes]]) -> dict:
+        ''' Return the raw data frames of the keys which are found and not
+            expired. The frames are read in the order they are stored in the
+            data file and the kernel is asked to read ahead all of them before
+            the first one is copied. '''
+        assert self.data_file_read_fd, 'Cache is closed'
+        frames = []
+        now = time.time()
+        key_slot = self._key_slot
+        starts, lengths, expires = self._starts, self._lengths, self._expires
+        for key in keys:
+            slot = key_slot.get(key.encode('utf-8') if isinstance(key, str) else key)
+            if slot is not None and (not expires[slot] or expires[slot] >= now):
+                frames.append((starts[slot], lengths[slot], key))
+            else:
+                self._misses += 1
+        frames.sort(key=lambda frame: frame[0])
+        self._will_need_frames_unsafe(frames)
+        result = {}
+        for start, length, key in frames:
+            result[key] = self._read_raw_frame_unsafe(start, length)
+        self._hits += len(frames)
+        return result
+
+    def _will_need_frames_unsafe(self, frames: list):
+        ''' Advise the kernel to read ahead the mapped ranges of the data file
+            which hold the given (start, length, key) frames, sorted by start.
+            Frames close to each other are advised as one range. '''
+        if len(frames) < 2 or self._data_mm is None or not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        gap = mmap.PAGESIZE * 16
+        ranges = []
+        for start, length, _ in frames:
+            end = min(start + length, self._mapped_len)
+            if start >= end:
+                break
+            if ranges and start - ranges[-1][1] <= gap:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        for start, end in ranges:
+            # madvise() needs a page aligned start
+            aligned = start - start % mmap.PAGESIZE
+            self._data_mm.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+
+    def has(self, key: Union[str, bytes]) -> bool:
         ''' Check if a key is in the cache and it not expired. '''
         with self._thread_lock:
             return self._has_unsafe(key)
         
-    def _has_unsafe(self, key: str) -> bool:
-        ''' Check if a key is in the cache and it not expired without locking. '''
-        assert isinstance(key, str), 'Key must be a string'
-        assert self.data_file_read_fd, 'Cache is closed'
-        if (key not in self.index) or (self.index[key]['expires'] and time.time() > self.index[key]['expires']):
+    def _has_unsafe(self, key: Union[str, bytes]) -> bool:
+        ''' Check if a key is in the cache and it not expired without locking.
+            The clock is only read for keys with a TTL. '''
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        slot = self._key_slot.get(key)
+        if slot is None:
             return False
-        return True
+        expires = self._expires[slot]
+        return not expires or expires >= time.time()
 
-    def delete(self, key: str):
+    def delete(self, key: Union[str, bytes]):
         ''' Thread safe version of self._delete(). '''
         with self._thread_lock:
             return self._delete_unsafe(key)
 
-    def _delete_unsafe(self, key: str):
+    def _delete_unsafe(self, key: Union[str, bytes]):
         ''' Delete a key from the cache. '''
-        assert isinstance(key, str), 'Key must be a string'
         assert self.data_file_read_fd, 'Cache is closed'
-        if key in self.index:
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        if key in self._key_slot:
             self._append_to_wal_file_unsafe(key, None)
-            del self.index[key]
-            self.stats['deletes'] += 1
-
-    def delete_startswith(self, key: str):
-        ''' Delete all keys from the cache that start with the given prefix. '''
+            self._index_remove_unsafe(key)
+            self._deletes += 1
+
+    def delete_startswith(self, key: Union[str, bytes]):
+        ''' Delete all keys from the cache that start with the given prefix.
+            The keys are found with a binary search in the sorted keys. '''
+        if isinstance(key, str):
+            key = key.encode('utf-8')
         with self._thread_lock:
-            keys = [k for k in self.index.keys() if k.startswith(key)]
-            for k in keys:
+            keys = self._sorted_keys_unsafe()
+            start = end = bisect_left(keys, key)
+            while end < len(keys) and keys[end].startswith(key):
+                end += 1
+            # keys which are already deleted are skipped by `_delete_unsafe()`
+            for k in keys[start:end]:
                 self._delete_unsafe(k)
+            del keys[start:end]
+
+    def _sorted_keys_unsafe(self) -> list:
+        ''' Return the sorted list of keys, with the keys which are added
+            since the last call. The list can have keys which are deleted,
+            and a key more than once if it was deleted and set again. '''
+        keys = self._sorted_keys
+        if keys is None or len(keys) + len(self._unsorted_keys) > 2 * len(self._key_slot):
+            # too many deleted keys, build the list again
+            keys = self._sorted_keys = sorted(self._key_slot)
+        elif len(self._unsorted_keys) <= 64:
+            for k in self._unsorted_keys:
+                insort(keys, k)
+        else:
+            # sort() merges the sorted runs in linear time
+            keys += sorted(self._unsorted_keys)
+            keys.sort()
+        self._unsorted_keys = []
+        return keys
 
-    def when_expired(self, key: str, relative=False) -> int:
+    def when_expired(self, key: Union[str, bytes], relative=False) -> int:
         ''' Return the expiration timestamp of a key. If `relative` is True,
             return the relative time in seconds. '''
+        key_bytes = key.encode('utf-8') if isinstance(key, str) else key
         with self._thread_lock:
-            assert isinstance(key, str), 'Key must be a string'
+            assert isinstance(key_bytes, bytes), 'Key must be a string or bytes'
             assert self.data_file_read_fd, 'Cache is closed'
-            if key in self.index:
-                return int(self.index[key]['expires'] - time.time()) if relative else self.index[key]['expires']
+            slot = self._key_slot.get(key_bytes)
+            if slot is not None:
+                expires = self._expires[slot]
+                return int(expires - time.time()) if relative else expires
             raise KeyError(f'Key `{key}` is not found')
 
     def get_stats(self) -> dict:
@@ -448,14 +1356,25 @@ class BlobCache:
         with self._thread_lock:
             return self._get_stats_unsafe()
 
+    @property
+    def stats(self) -> dict:
+        ''' The counters of the cache, `get_stats()` also returns the
+            file statistics. '''
+        return {
+            'hits': self._hits,
+            'sets': self._sets,
+            'deletes': self._deletes,
+            'misses': self._misses,
+            'refreshes': self._refreshes,
+        }
+
     def _get_stats_unsafe(self) -> dict:
         ''' Return the cache statistics. '''
-        fragmentation_ratio = self._fragmentation_ratio_unsafe()
-        data_file_size = self.data_file_append_fd.tell()
-        self.stats['fragmentation_ratio']  = fragmentation_ratio
-        self.stats['total_keys']  = len(self.index)
-        self.stats['data_file_size_bytes'] = data_file_size
-        return self.stats
+        stats = self.stats
+        stats['fragmentation_ratio'] = self._fragmentation_ratio_unsafe()
+        stats['total_keys'] = len(self._key_slot)
+        stats['data_file_size_bytes'] = self._data_end
+        return stats
 
     def fragmentation_ratio(self):
         ''' Thread safe version of self._fragmentation_ratio(). '''
@@ -468,13 +1387,10 @@ class BlobCache:
             Higher value means more fragmented. 0.8 means only 20% is used for
             data, the rest of the data file is old. '''
         assert self.data_file_read_fd, 'Cache is closed'
-        size_file = self.data_file_append_fd.tell() - len(self.header_data_file)
+        size_file = self._data_end - len(self.header_data_file)
         if size_file <= 0:
             return 0
-        size_index = 0
-        for _, entry in self.index.items():
-            size_index += entry['length']
-        return 1 - (size_index / size_file)
+        return 1 - (self._live_bytes / size_file)
 
     def vacuum(self):
         ''' Thread safe version of self._vacuum(). '''
@@ -483,27 +1399,64 @@ class BlobCache:
 
     def _vacuum_unsafe(self):
         ''' Rebuild the data file to remove fragmentation by removing
-            the data which is not in the index. '''
+            the data which is not in the index. The frames are copied in the
+            order they are stored, so the old file is read sequentially, and
+            adjacent frames are copied as one range. '''
         assert self.data_file_read_fd, 'Cache is closed'
         LOG.debug("Vacuuming data file...")
+        self._sync_unsafe()
         tmp_data_file = self.data_file + '.tmp'
-        new_index = {}
-        with open(tmp_data_file, 'wb') as new_file:
-            self._write_header_unsafe()
-            for key, entry in self.index.items():
-                self.data_file_read_fd.seek(entry['start'])
-                data_frame = self.data_file_read_fd.read(entry['length'])
-                new_start = new_file.tell()
-                new_file.write(data_frame)
-                new_index[key] = {
-                    'start': new_start,
-                    'length': len(data_frame),
-                    'expires': entry['expires'],
-                }
-
-        os.replace(tmp_data_file, self.data_file)
-        self.index = new_index
-        self._save_index_unsafe()
+        starts, lengths, expires = self._starts, self._lengths, self._expires
+        # the new index entries are collected aside, the index is only
+        # replaced when the new data file replaced the old one
+        entries = []
+        src_fd = self.data_file_read_fd.fileno()
+        dst_fd = os.open(tmp_data_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            try:
+                os.write(dst_fd, self.header_data_file)
+                # the range of adjacent frames in the old file which is not
+                # copied yet, and where it is copied to
+                run_start = run_end = 0
+                run_dst = len(self.header_data_file)
+                for key, slot in sorted(self._key_slot.items(), key=lambda item: starts[item[1]]):
+                    start = starts[slot]
+                    if start != run_end:
+                        run_dst += _copy_range(src_fd, dst_fd, run_end - run_start, run_start, run_dst)
+                        run_start = start
+                    entries.append((key, run_dst + start - run_start, lengths[slot], expires[slot]))
+                    run_end = start + lengths[slot]
+                _copy_range(src_fd, dst_fd, run_end - run_start, run_start, run_dst)
+                _fdatasync(dst_fd)
+            finally:
+                os.close(dst_fd)
+            os.replace(tmp_data_file, self.data_file)
+        except BaseException:
+            # e.g. the disk is full, the old data file and index are kept
+            if os.path.exists(tmp_data_file):
+                os.remove(tmp_data_file)
+            raise
+
+        self._reset_index_unsafe()
+        for entry in entries:
+            self._index_put_unsafe(*entry)
+        # the frames are moved
+        self._value_cache.clear()
+        self._reopen_data_file_unsafe()
+        self._checkpoint_unsafe()
+
+    def _reopen_data_file_unsafe(self):
+        ''' Reopen and lock the data file after it was replaced. '''
+        self._unmap_data_file_unsafe()
+        data_file_append_fd = self._open_data_file()
+        self._data_end = data_file_append_fd.seek(0, os.SEEK_END)
+        self._lock_file_unsafe(data_file_append_fd)
+        self._unlock_file_unsafe(self.data_file_append_fd)
+        self.data_file_append_fd.close()
+        self.data_file_append_fd = data_file_append_fd
+        self.data_file_read_fd.close()
+        self.data_file_read_fd = open(self.data_file, 'rb')
+        self._allocated_bytes = self._data_end
 
     def close(self):
         ''' Close the cache. Closes all files and saves the index. '''
@@ -511,12 +1464,18 @@ class BlobCache:
         with self._thread_lock:
             if not self.data_file_read_fd:
                 raise RuntimeError('Cache is already closed')
+            atexit.unregister(self._atexit_hook)
 
+            self._sync_unsafe()
             stats = self._get_stats_unsafe()
 
             if self._fragmentation_ratio_unsafe() > self.auto_vacuum_threshold:
                 LOG.debug(f"Auto vacuuming data file as fragmentation ratio is higher than {self.auto_vacuum_threshold}.")
                 self._vacuum_unsafe()
+            self._unmap_data_file_unsafe()
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
             if self.data_file_read_fd:
                 self.data_file_read_fd.close()
                 self.data_file_read_fd = None
@@ -524,6 +1483,7 @@ class BlobCache:
                 self.wal_file_fd.close()
                 self.wal_file_fd = None
             if self.data_file_append_fd:
+                self._truncate_data_file_unsafe()
                 self._unlock_file_unsafe(self.data_file_append_fd)
                 self.data_file_append_fd.close()
                 self.data_file_append_fd = None
@@ -1,12 +1,22 @@
 from blob_cache import BlobCache
 
+def _decode_key(key):
+    ''' Keys are stored as UTF-8 bytes, keys which were set as bytes and
+        are not UTF-8 are returned as bytes. '''
+    try:
+        return key.decode('utf-8')
+    except UnicodeDecodeError:
+        return key
+
 class BlobCacheDict(BlobCache):
 
     def __len__(self):
-        return len(self.index)
+        return len(self._key_slot)
 
     def __contains__(self, key):
-        return key in self.index
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return key in self._key_slot
 
     def __getitem__(self, key):
         return self.get(key)
@@ -15,17 +25,17 @@ class BlobCacheDict(BlobCache):
         self.set(key, value)
 
     def __iter__(self):
-        for key in self.index:
-            yield key
+        for key in self._key_slot:
+            yield _decode_key(key)
 
     def __delitem__(self, key):
         self.delete(key)
 
     def keys(self):
-        return (k for k in self.index.keys())
+        return (_decode_key(k) for k in self._key_slot)
 
     def values(self):
-        return (self.get(k) for k in self.index.keys())
+        return (self.get(k) for k in self._key_slot)
 
     def items(self):
-        return ((k, self.get(k)) for k in self.index.keys())
+        return ((_decode_key(k), self.get(k)) for k in self._key_slot)
@@ -1,5 +1,12 @@
+import blob_cache
+from blob_cache import BlobCache
 from blob_cache_dict import BlobCacheDict
 from benchmark import alphanumeric_string
+import datetime
+import os
+import random
+import subprocess
+import sys
 import time
 
 rnd = alphanumeric_string(1*1024**2)  # 1mb
@@ -38,6 +45,32 @@ for k,v in t.items():
         print('FAILED')
 
 
+print('----')
+print('Setting JSON values with NaN, Infinity and integers beyond 64 bits...')
+j = {'nan': float('nan'), 'inf_list': [float('inf'), 1], 'int_2**70': 2**70, 'int_dict': {'a': 2**65}, 'int_negative': -2**63 - 1, 'none_nan': [None, float('nan')]}
+for k,v in j.items():
+    c[k] = v
+for k,v in j.items():
+    print(f'Comparing key: `{k}`...', end='')
+    # repr() compares NaN too
+    print('OK' if repr(c[k]) == repr(v) else 'FAILED')
+    del c[k]
+print('Setting a dict with a datetime value...', end='')
+try:
+    c['datetime'] = {'datetime': datetime.datetime.now()}
+    print('FAILED')
+except TypeError:
+    print('OK')
+
+
+print('----')
+print('Setting a bytes key which is not UTF-8...')
+c[b'\xff'] = 1
+print('Iterating keys...', end='')
+print('OK' if b'\xff' in list(c) and b'\xff' in list(c.keys()) and dict(c.items())[b'\xff'] == 1 else 'FAILED')
+del c[b'\xff']
+
+
 print('----')
 print('Setting key `delete`...')
 c['delete'] = 'delete'
@@ -47,6 +80,23 @@ del c['delete']
 print(f'Has key `delete`: {c.has("delete")}')
 
 
+print('----')
+print('Setting keys with `set_many`...')
+c.set_many({f'many_{i}': i for i in range(100)})
+print(f'Comparing keys from `set_many`...', end='')
+print('OK' if all(c[f'many_{i}'] == i for i in range(100)) else 'FAILED')
+print(f'Comparing keys from `get_many`...', end='')
+print('OK' if c.get_many(f'many_{i}' for i in range(101)) == {f'many_{i}': i for i in range(100)} else 'FAILED')
+print('Setting keys within `group_commit`...')
+with c.group_commit():
+    for i in range(100):
+        c[f'group_{i}'] = str(i)
+print(f'Comparing keys from `group_commit`...', end='')
+print('OK' if all(c[f'group_{i}'] == str(i) for i in range(100)) else 'FAILED')
+c.delete_startswith('many_')
+c.delete_startswith('group_')
+
+
 print('----')
 c.set('2sec_ttl', 'value', ttl=2)
 for _ in range(5):
@@ -78,3 +128,199 @@ print(f'Fragmentation: {f}')
 c.close()
 
 
+print('----')
+print('Comparing `delete_startswith` with a set of the expected keys...', end='')
+m = BlobCache('tmp_test_prefix_cache')
+m.delete_startswith('')
+expected = set()
+ok = True
+r = random.Random(1)
+def random_key():
+    return ''.join(r.choice('ab\xffé') for _ in range(r.randint(0, 4)))
+for step in range(5000):
+    op = r.random()
+    if op < 0.5:
+        key = random_key()
+        m.set(key, step)
+        expected.add(key)
+    elif op < 0.75:
+        key = random_key()
+        m.delete(key)
+        expected.discard(key)
+    elif op < 0.95:
+        prefix = random_key()[:r.randint(0, 3)]
+        m.delete_startswith(prefix)
+        expected = {k for k in expected if not k.startswith(prefix)}
+    elif op < 0.96:
+        # many new keys at once, which are merged with one sort
+        for i in range(100):
+            m.set(f'a{i}', i)
+            expected.add(f'a{i}')
+    elif op < 0.97:
+        m.vacuum()
+    ok = ok and {k.decode('utf-8') for k in m._key_slot} == expected
+m.close()
+m = BlobCache('tmp_test_prefix_cache')
+m.delete_startswith('a')
+ok = ok and {k.decode('utf-8') for k in m._key_slot} == {k for k in expected if not k.startswith('a')}
+m.close()
+print('OK' if ok else 'FAILED')
+
+
+print('----')
+print('Reading a data frame with a flipped byte...', end='')
+k = BlobCache('tmp_test_crc_cache')
+k.set('a', 'x' * 1000)
+k.set('b', 'y' * 1000)
+start = k._starts[k._key_slot[b'b']]
+k.close()
+with open('tmp_test_crc_cache.data.bin', 'r+b') as f:
+    f.seek(start + 10)
+    byte = f.read(1)
+    f.seek(start + 10)
+    f.write(bytes([byte[0] ^ 0xff]))
+k = BlobCache('tmp_test_crc_cache')
+try:
+    k.get('b')
+    print('FAILED')
+except ValueError:
+    print('OK' if k.get('a') == 'x' * 1000 else 'FAILED')
+k.delete('b')
+k.close()
+
+print('Replaying a WAL file with a torn last record...', end='')
+subprocess.check_call([sys.executable, '-c', (
+    'import os\n'
+    'from blob_cache import BlobCache\n'
+    'k = BlobCache("tmp_test_crc_cache", durability="flush")\n'
+    'k.set("c", 1)\n'
+    'k.set("d", 2)\n'
+    'os._exit(0)\n'
+)])
+with open('tmp_test_crc_cache.wal.bin', 'r+b') as f:
+    f.truncate(f.seek(0, 2) - 3)
+k = BlobCache('tmp_test_crc_cache')
+print('OK' if k.get('c') == 1 and not k.has('d') and k.get('a') == 'x' * 1000 else 'FAILED')
+k.close()
+
+
+print('----')
+print('Setting keys past `wal_checkpoint_size` in a process which crashes...', end='')
+# os._exit() skips the exit hook which writes an unclosed cache, so the keys
+# are only in the index if the checkpoints saved it
+restarted = subprocess.call([sys.executable, '-c', (
+    'import os\n'
+    'from blob_cache import BlobCache\n'
+    'w = BlobCache("tmp_test_checkpoint_cache", durability="flush")\n'
+    'w.wal_checkpoint_size = 4096\n'
+    'for i in range(1000): w.set(f"checkpoint_{i}", i)\n'
+    'w.delete("checkpoint_0")\n'
+    'os._exit(0 if os.path.getsize("tmp_test_checkpoint_cache.wal.bin") < 4096 + 100 else 1)\n'
+)]) == 0
+w = BlobCache('tmp_test_checkpoint_cache')
+print('OK' if restarted and not w.has('checkpoint_0') and all(w.has(f'checkpoint_{i}') and w.get(f'checkpoint_{i}') == i for i in range(1, 1000)) else 'FAILED')
+w.delete_startswith('checkpoint_')
+w.close()
+print('Setting keys after a checkpoint which fails to save the index...', end='')
+# a directory in place of the temporary index file makes the save fail
+w = BlobCache('tmp_test_checkpoint_cache', durability='flush')
+w.wal_checkpoint_size = 4096
+os.mkdir('tmp_test_checkpoint_cache.index.bin.tmp')
+failed = False
+try:
+    for i in range(200):
+        w.set(f'checkpoint_{i}', i)
+except OSError:
+    failed = True
+os.rmdir('tmp_test_checkpoint_cache.index.bin.tmp')
+w.set('checkpoint_after', 1)
+w.close()
+w = BlobCache('tmp_test_checkpoint_cache')
+print('OK' if failed and w.has('checkpoint_after') and all(w.has(f'checkpoint_{j}') for j in range(i)) else 'FAILED')
+w.delete_startswith('checkpoint_')
+w.close()
+
+
+print('----')
+print('Syncing a `group_commit` with `durability="fdatasync"`...', end='')
+g = BlobCache('tmp_test_group_cache', durability='fdatasync')
+fdatasync = blob_cache._fdatasync
+synced = []
+blob_cache._fdatasync = lambda fd: (synced.append(fd), fdatasync(fd))
+try:
+    with g.group_commit():
+        for i in range(10):
+            g.set(f'group_{i}', i)
+        synced_in_block = len(synced)
+finally:
+    blob_cache._fdatasync = fdatasync
+print('OK' if synced_in_block == 0 and len(synced) == 2 else 'FAILED')
+g.delete_startswith('group_')
+g.close()
+
+
+print('----')
+print('Setting a key with a TTL out of range...', end='')
+o = BlobCache('tmp_test_range_cache')
+o.set('range_c', 3, ttl=99)
+try:
+    o.set('range_a', 1, ttl=2**33)
+    print('FAILED')
+except ValueError:
+    o.set('range_b', 2)
+    print('OK' if not o.has('range_a') and o.when_expired('range_b') == 0 and o.get('range_c') == 3 else 'FAILED')
+o.delete_startswith('range_')
+o.close()
+
+
+print('----')
+print('Vacuuming a cache when the disk gets full...', end='')
+v = BlobCache('tmp_test_vacuum_cache')
+for i in range(50):
+    v.set(f'vacuum_{i}', i)
+for i in range(0, 50, 2):
+    v.delete(f'vacuum_{i}')
+copy_range = blob_cache._copy_range
+calls = []
+def failing_copy_range(*args):
+    calls.append(args)
+    if len(calls) == 3:
+        raise OSError(28, 'No space left on device')
+    return copy_range(*args)
+blob_cache._copy_range = failing_copy_range
+try:
+    v.vacuum()
+    vacuum_failed = False
+except OSError:
+    vacuum_failed = True
+finally:
+    blob_cache._copy_range = copy_range
+ok = vacuum_failed and all(v.get(f'vacuum_{i}') == i for i in range(1, 50, 2))
+v.close()
+v = BlobCache('tmp_test_vacuum_cache')
+ok = ok and all(v.get(f'vacuum_{i}') == i for i in range(1, 50, 2))
+v.delete_startswith('vacuum_')
+v.close()
+print('OK' if ok else 'FAILED')
+
+
+print('----')
+print('Setting keys in a cache with `thread_safe=False`...')
+u = BlobCache('tmp_test_unsafe_cache', thread_safe=False)
+u.set_many({f'unsafe_{i}': i for i in range(100)})
+print('Comparing keys from `get_many`...', end='')
+print('OK' if u.get_many(f'unsafe_{i}' for i in range(101)) == {f'unsafe_{i}': i for i in range(100)} else 'FAILED')
+u.close()
+
+
+print('----')
+print('Setting keys in a process which exits without `close()`...')
+subprocess.check_call([sys.executable, '-c', (
+    'from blob_cache import BlobCache\n'
+    'e = BlobCache("tmp_test_exit_cache")\n'
+    'for i in range(500): e.set(f"exit_{i}", i)\n'
+)])
+e = BlobCache('tmp_test_exit_cache')
+print('Comparing keys after reopening...', end='')
+print('OK' if all(e.has(f'exit_{i}') and e.get(f'exit_{i}') == i for i in range(500)) else 'FAILED')
+e.close()